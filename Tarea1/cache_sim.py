@@ -6,667 +6,614 @@ import csv
 default_programcpu1 = "mem_trace_core1.txt"
 default_programcpu2 = "mem_trace_core2.txt"
 
+# default topology and issue weights (cpu1 runs 3 instructions for each cpu2 instruction)
+default_topology = "default"
+default_weights = "3,1"
+
+# trace modes, L(Read) or S(Write), and whether they write
+write_modes = {'L': False, 'S': True}
+
 
 ###############################################################################
 # CSV data logger, writes number of misses per cache to a csv file
 filename_csv = 'misses_dat.csv'
+csv_buffer_rows = 4096   # rows kept in memory before writing them to the file
 
 
 class CSVLog:
 
-    def __init__(self):
-        with open(filename_csv, 'w') as csvfile:
-            # sets header and fields
-            self.fieldnames = ['Cycle CPU1', 'Cycle CPU2', 'Misses L1 CPU1', 'Misses L1 CPU2', 'Misses L2']
-            self.writer = csv.DictWriter(csvfile, fieldnames=self.fieldnames)
-            self.writer.writeheader()
-
-    def write(self, cyclecpu1, cyclecpu2, missesL1, missesLL1, missesL2):
-        """
-        Adds a row to the csv file.
-        :param cyclecpu1: Number of cycles for the cpu1.
-        :param cyclecpu2: Number of cycles for the cpu2.
-        :param missesL1: Number of misses for the L1-cpu1 cache.
-        :param missesLL1: Number of misses for the L1-cpu2 cache.
-        :param missesL2: Number of misses for the L2 shared cache.
-        :return: None
+    def __init__(self, fieldnames):
         """
-        with open(filename_csv, 'a') as csvfile:
-            self.writer = csv.DictWriter(csvfile, fieldnames=self.fieldnames)
-            self.writer.writerow({'Cycle CPU1': cyclecpu1, 'Cycle CPU2': cyclecpu2,
-                                  'Misses L1 CPU1': missesL1, 'Misses L1 CPU2': missesLL1,
-                                  'Misses L2': missesL2})
-
-
-###############################################################################
-# Functions for addresses manipulation
-def get_fields(address, tagb, indexb):
-    """
-    Extracts the index, tag and offset values from a given address.
-    :param address: Int, memory address to parse.
-    :param tagb: bit position of first tag bit.
-    :param indexb: bit position of first index bit.
-    :return: index, tag and offset as a list of ints.
-    """
-    index = address/(2**indexb)
-    tag = (address % (2**indexb))/(2**tagb)
-    offset = (address % (2**tagb))
-    return [index, tag, offset]
-
-
-def form_address(index, indexb, tag, tagb, offset):
-    """
-    Forms the full address, given an index, tag and offset, the bit positions
-    of index and tag are necessary to form the address
-    :param index: Int.
-    :param indexb: Int, bit position of first index bit.
-    :param tag: Int.
-    :param tagb: Int, bit position of first tag bit.
-    :param offset: Int.
-    :return: Int, the corresponding formed address.
-    """
-    return index*(2**indexb)+tag*(2**tagb)+offset
-
-
-###############################################################################
-"""
-Represents cache Level 1
-
-    +-----------+
-    |   Set0    |
-    +-----------+
-    |   Set1    |
-    +-----------+
-    |   ...     |
-    +-----------+
-
-"""
-
-
-class CacheL1:
-
-    def __init__(self, n_sets, n_blocks_ps):
-        """
-        Creates a L1 cache.
-        :param n_sets: Number of sets in the cache.
-        :param n_blocks_ps: Number of blocks per set.
-        """
-        self.n_sets = n_sets
-        self.n_blocks_ps = n_blocks_ps
-        self.sets = []
-        for n in range(n_sets):
-            self.sets += [SetLru(n_blocks_ps)]
-
-    def read(self, address):
-        """
-        Returns the state of a block in the L1 cache, given an address.
-        :param address: Int, memory address.
-        :return: Returns the state of a given address in the L1 cache, where the state may be
-        M(Modified), E(Exclusive), S(Shared), I(Invalid) and N(Not present) is used to indicate that there is no
-        corresponding entry.
+        Creates the csv file and writes its header, the file stays open until close() is called.
+        :param fieldnames: List of column names.
         """
-        [index, tag, offset] = get_fields(address, 5, 16)
-        return self.sets[index].read(tag)
+        self.fieldnames = fieldnames
+        self.csvfile = open(filename_csv, 'w')
+        self.writer = csv.writer(self.csvfile)
+        self.writer.writerow(self.fieldnames)
+        self.rows = []
 
-    def set_state(self, address, mode):
+    def write(self, row):
         """
-        Sets the state of a given block in the L1 cache.
-        :param address: Int, memory address.
-        :param mode: New block state, may be [MESI].
-        :return: None.
+        Adds a row to the csv file, rows are buffered and written in batches.
+        :param row: List of values, in the same order as the header.
+        :return: None
         """
-        [index, tag, offset] = get_fields(address, 5, 16)
-        self.sets[index].set_state(tag, mode)
+        self.rows.append(row)
+        if len(self.rows) == csv_buffer_rows:
+            self.flush()
 
-    def update_set(self, address, state):
+    def flush(self):
         """
-        Writes a tag and a corresponding state to L1 cache.
-        :param address: Int, memory address.
-        :param state: State for the corresponding new block, may be [MESI].
-        :return: None.
+        Writes the buffered rows to the csv file.
+        :return: None
         """
-        [index, tag, offset] = get_fields(address, 5, 16)
-        self.sets[index].update_set(tag, state)
+        self.writer.writerows(self.rows)
+        self.rows = []
 
-    def get_similar(self, address):
+    def close(self):
         """
-        Gets the address of block in L1 cache that it is about to be replaced.
-        :param address: Int, memory address of the new value.
-        :return: Int, memory address of the block to be replaced by the new block.
+        Writes the pending rows and closes the csv file.
+        :return: None
         """
-        [index, tag, offset] = get_fields(address, 5, 16)
-        existent_tag = self.sets[index].get_lrutag()
-        return form_address(index, 16, existent_tag, 5, 0)
-
-###############################################################################
+        self.flush()
+        self.csvfile.close()
 
 
 ###############################################################################
 """
-Represents a set in a n-way associative cache(n_blocks_pl=n)
-    +----------+--------------+--------------+-----+
-    | LRU bits |    Block0    |    Block1    | ... |
-    +----------+--------------+--------------+-----+
+Declarative description of the cache hierarchy, levels go from the closest to
+the cores to the farthest one, each level may be private, shared by a cluster
+of cores or shared by all cores
+
+    CPU1 CPU2 CPU3 CPU4     cores_per_cache
+    +--+ +--+ +--+ +--+
+    |L1| |L1| |L1| |L1|     1 (private)
+    +--+ +--+ +--+ +--+
+    +-------+ +-------+
+    |  L2   | |  L2   |     2 (cluster)
+    +-------+ +-------+
+    +-----------------+
+    |       L3        |     None (shared)
+    +-----------------+
 
 """
 
 
-class SetLru:
-    def __init__(self, n_blocks):
-        """
-        Creates a n-way set associative, where n=n_blocks.
-        :param n_blocks: Number of blocks per set.
-        """
-        self.n_blocks = n_blocks
-        self.lrubits = [1]*self.n_blocks  # indicates least recent used block
-        self.lrubits[0] = 0
-        self.blocks = []
-        for n in range(n_blocks):
-            self.blocks += [BlockMESI()]
-
-    def read(self, tag):
-        """
-        Returns the state of a block in the set, given a tag.
-        :param tag: Int.
-        :return: Returns the state of a given address in the L1 cache, where the state may be
-        M(Modified), E(Exclusive), S(Shared), I(Invalid) and N(Not present) is used to indicate that there is no
-        corresponding entry.
-        """
-        # tries to find valid blocks
-        n = 0
-        for bl in self.blocks:
-            if bl.get_tag() == tag and bl.get_state() != "I":
-                # value present in L1
-                self.lrubits = [1]*self.n_blocks
-                self.lrubits[n] = 0
-                return bl.get_state()
-            n += 1
-
-        # if there are no valid blocks, search for invalid blocks
-        n = 0
-        for bl in self.blocks:
-            if bl.get_tag() == tag:
-                # value present in L1
-                self.lrubits = [1] * self.n_blocks
-                self.lrubits[n] = 0
-                return bl.get_state()
-            n += 1
-
-        # value not present in L1
-        return "N"
-
-    def update_set(self, tag, state):
-        """
-        Writes a tag and a corresponding state to the set, according to the LRU bits.
-        :param tag: Int.
-        :param state: State for the new block, may be [MESI].
-        :return: None.
-        """
-        block_idx = self.lrubits.index(1)  # finds LRU block
-        self.blocks[block_idx].set_tag(tag)  # overwrites that block
-        self.blocks[block_idx].set_state(tag, state)
-        self.lrubits = [1] * self.n_blocks
-        self.lrubits[block_idx] = 0  # now the state is recent
+class LevelSpec:
 
-    def set_state(self, tag, state):
+    def __init__(self, name, n_sets, n_ways, cores_per_cache=1):
         """
-        Sets the state of a block in the set, given a tag.
-        :param tag: Int.
-        :param state: State for the new block, may be [MESI].
-        :return: None.
+        Describes one level of the hierarchy.
+        :param name: String, name of the level, e.g. L2.
+        :param n_sets: Number of sets of each cache in the level, must be a power of two.
+        :param n_ways: Number of blocks per set, 1 for a direct-mapped cache.
+        :param cores_per_cache: Number of cores sharing each cache of the level, 1 for private caches,
+        None for a single cache shared by all cores.
         """
-        n = 0
-        for bl in self.blocks:
-
-            if bl.get_tag() == tag:
-                # value present in L1
-                self.blocks[n].set_state(tag, state)
-            n += 1
-
-    def get_lrutag(self):
-        """
-        Returns the tag of the LRU block.
-        :return: Int, tag of LRU block.
-        """
-        return self.blocks[self.lrubits.index(1)].get_tag()
-
-
-###############################################################################
+        self.name = name
+        self.n_sets = n_sets
+        self.n_ways = n_ways
+        self.cores_per_cache = cores_per_cache
+
+
+# available topologies, as (number of cores, levels)
+topologies = {
+    # two private L1 and one shared direct-mapped L2
+    "default": (2, [LevelSpec("L1", 256, 2),
+                    LevelSpec("L2", 4*1024, 1, None)]),
+    # private L1 and L2 per core, shared L3
+    "private_l2": (2, [LevelSpec("L1", 256, 2),
+                       LevelSpec("L2", 1024, 4),
+                       LevelSpec("L3", 8*1024, 8, None)]),
+    # 16 cores, clusters of 4 cores sharing an L2, shared L3
+    "cluster16": (16, [LevelSpec("L1", 256, 2),
+                       LevelSpec("L2", 1024, 4, 4),
+                       LevelSpec("L3", 8*1024, 16, None)]),
+}
+
+
+def parse_levels(text):
+    """
+    Parses a hierarchy description, levels are separated by commas and each one is
+    name:setsxways:sharing, where sharing may be private, shared or a number of cores.
+    E.g. L1:256x2:private,L2:1024x4:4,L3:8192x16:shared
+    :param text: String, hierarchy description.
+    :return: List of LevelSpec objects.
+    """
+    levels = []
+    for level in text.split(","):
+        fields = level.strip().split(":")
+        if len(fields) != 3:
+            raise ValueError("Invalid level {0}, expected name:setsxways:sharing".format(level))
+        name, geometry, sharing = fields
+        try:
+            n_sets, n_ways = [int(n) for n in geometry.split("x")]
+        except ValueError:
+            raise ValueError("Invalid geometry {0} in level {1}, expected setsxways".format(geometry, name))
+        if sharing == "private":
+            cores_per_cache = 1
+        elif sharing == "shared":
+            cores_per_cache = None
+        elif sharing.isdigit():
+            cores_per_cache = int(sharing)
+        else:
+            raise ValueError("Invalid sharing {0} in level {1}, may be private, shared or "
+                             "a number of cores".format(sharing, name))
+        levels += [LevelSpec(name, n_sets, n_ways, cores_per_cache)]
+    return levels
 
 
 ###############################################################################
 """
-Represents cache Level 2
-
-    +------------+
-    |    Set0    |
-    +------------+
-    |    Set1    |
-    +------------+
-    |    ...     |
-    +------------+
+Represents a n-way set associative cache with LRU replacement, a direct-mapped
+cache is the case n_ways=1. Only valid blocks are stored, a block not present
+in lines is Invalid. Each set always has n_ways entries, invalid ways are None
+and are kept in the LRU end, so they are replaced first.
+
+    +----------+-------------------------+
+    | lines    | block -> state [MES]    |
+    +----------+-------------------------+
+    | Set0     | blocks, from LRU to MRU |
+    +----------+-------------------------+
+    | ...      |                         |
+    +----------+-------------------------+
 
 """
 
 
-class CacheL2:
-    def __init__(self, n_sets):
-        """
-        Creates a direct-mapped cache L2, with a given number of sets.
-        :param n_sets: Number of sets in the cache.
-        """
-        self.n_sets = n_sets
-        self.sets = []
-        for n in range(n_sets):
-            self.sets += [BlockMESI()]
+class Cache:
 
-    def read(self, address):
+    def __init__(self, name, first_core, n_sets, n_ways):
         """
-        Gets the state of a block in the cache, given an address.
-        :param address:
-        :return: State of the block, may be [MESI], if it's not present returns [N].
+        Creates an empty cache.
+        :param name: String, name of the cache, e.g. L1 CPU1.
+        :param first_core: Int, first core of the ones sharing the cache.
+        :param n_sets: Number of sets in the cache, must be a power of two.
+        :param n_ways: Number of blocks per set.
         """
-        [index, tag, offset] = get_fields(address, 5, 12)
-        return self.sets[index].read(tag)
+        self.name = name
+        self.first_core = first_core
+        self.index_mask = n_sets - 1
+        self.lines = {}
+        self.sets = [[None]*n_ways for n in range(n_sets)]
+        self.parent = None
+        self.children = []
 
-    def update_set(self, address, state):
-        """
-        Writes a tag and a corresponding state to the set.
-        :param tag: Int.
-        :param state: State for the new block, may be [MESI].
-        :return: None.
-        """
-        [index, tag, offset] = get_fields(address, 5, 12)
-        self.sets[index].set_tag(tag)
-        self.sets[index].set_state(tag, state)
+        # relevant info about performance
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
 
-    def set_state(self, address, state):
+    def touch(self, block):
         """
-        Sets the state of a block in the set, given a tag.
-        :param tag: Int.
-        :param state: State for the new block, may be [MESI].
+        Marks a present block as the most recently used of its set.
+        :param block: Int, block address.
         :return: None.
         """
-        [index, tag, offset] = get_fields(address, 5, 12)
-        self.sets[index].set_state(tag, state)
+        lru = self.sets[block & self.index_mask]
+        if lru[-1] != block:
+            lru.remove(block)
+            lru.append(block)
 
-    def get_similar(self, address):
+    def invalidate(self, block):
         """
-        Gets the address of the block in the L2 cache, that it is about to be replaced by a new block.
-        :param address: Int, new block address.
-        :return: Int, block address to be replaced.
+        Deletes a present block from the cache.
+        :param block: Int, block address.
+        :return: Previous state of the block, may be [MES].
         """
-        [index, tag, offset] = get_fields(address, 5, 12)
-        existent_tag = self.sets[index].get_tag()
-        return form_address(index, 12, existent_tag, 5, 0)
-
-###############################################################################
+        lru = self.sets[block & self.index_mask]
+        lru.remove(block)
+        lru.insert(0, None)
+        return self.lines.pop(block)
 
 
 ###############################################################################
-"""
-Represents a block and the associated MESI bits and tag
-    +------+-------+----------+
-    | MESI |  Tag  |   Data   |
-    +------+-------+----------+
-
-"""
-
+# Builds the caches described by a list of LevelSpec and propagates misses, evictions,
+# write-backs and MESI snoops through them. The hierarchy is inclusive, every block
+# in a cache is also present in its parent.
+class CacheHierarchy:
+
+    def __init__(self, n_cores, levels, block_bits=5, verbose=False):
+        """
+        Creates the caches for every level and links them.
+        :param n_cores: Number of cores.
+        :param levels: List of LevelSpec, from the closest to the cores to the farthest.
+        :param block_bits: Int, number of offset bits, blocks are 2**block_bits bytes.
+        :param verbose: Bool, prints the lookups, write-backs and invalidations of every access.
+        """
+        if n_cores < 1:
+            raise ValueError("Number of cores must be positive: {0}".format(n_cores))
+        if not levels:
+            raise ValueError("At least one cache level is required")
+
+        self.n_cores = n_cores
+        self.block_bits = block_bits
+        self.verbose = verbose
+        self.level_names = [spec.name for spec in levels]
+        self.levels = []
+        self.caches = []
+
+        group_sizes = []
+        for depth, spec in enumerate(levels):
+            size = n_cores if spec.cores_per_cache is None else spec.cores_per_cache
+            if spec.n_sets < 1 or spec.n_sets & (spec.n_sets - 1):
+                raise ValueError("Number of sets in {0} must be a power of two: {1}".format(spec.name, spec.n_sets))
+            if spec.n_ways < 1:
+                raise ValueError("Number of ways in {0} must be positive: {1}".format(spec.name, spec.n_ways))
+            if size < 1 or n_cores % size:
+                raise ValueError("{0} caches are shared by {1} cores, which does not divide {2} cores"
+                                 .format(spec.name, size, n_cores))
+            if group_sizes and size % group_sizes[-1]:
+                raise ValueError("{0} caches are shared by {1} cores, which is not a multiple of the {2} "
+                                 "cores sharing each {3} cache".format(spec.name, size, group_sizes[-1],
+                                                                      levels[depth - 1].name))
+
+            caches = []
+            for first_core in range(0, n_cores, size):
+                if size == n_cores:
+                    name = spec.name
+                elif size == 1:
+                    name = "{0} CPU{1}".format(spec.name, first_core + 1)
+                else:
+                    name = "{0} CPU{1}-{2}".format(spec.name, first_core + 1, first_core + size)
+                caches += [Cache(name, first_core, spec.n_sets, spec.n_ways)]
+
+            if self.levels:
+                for child in self.levels[-1]:
+                    child.parent = caches[child.first_core // size]
+                    child.parent.children += [child]
+
+            group_sizes += [size]
+            self.levels += [caches]
+            self.caches += caches
+
+        # first level with a single cache shared by all cores, a block missing there has no copies
+        self.shared_depth = group_sizes.index(n_cores) if n_cores in group_sizes else len(levels)
+
+        # caches used by each core, from L1 to the last level
+        self.paths = [tuple(self.levels[depth][core // group_sizes[depth]] for depth in range(len(levels)))
+                      for core in range(n_cores)]
+        # caches outside the path of each core whose parent is in the path, or that have no parent,
+        # since the hierarchy is inclusive any other copy of a block is below one of them
+        self.neighbours = []
+        for path in self.paths:
+            neighbours = [cache for cache in self.levels[-1] if cache is not path[-1]]
+            for depth in range(len(path) - 1, 0, -1):
+                neighbours += [cache for cache in path[depth].children if cache is not path[depth - 1]]
+            self.neighbours += [neighbours]
 
-class BlockMESI:
-    def __init__(self):
-        """
-        Creates a block, with an invalid state and meaningless tag and data.
-        """
-        self.MESI = "I"
-        self.tag = 0
-        self.data = 0  # dummy variable
+        # relevant info about performance
+        self.memory_reads = 0
+        self.memory_writebacks = 0
 
-    def read(self, tag):
+    def access(self, core, address, write):
         """
-        Returns the state for a given tag.
-        :param tag: Int.
-        :return: State for the corresponding block, where state may be [MESI], if it's not present returns [N].
-        """
-        if self.tag == tag:
-            return self.MESI
+        Simulates a read/write of an address by a core.
+        :param core: Int, core index.
+        :param address: Int, memory address to read/write.
+        :param write: Bool, True for a write.
+        :return: Int, level where the block was found, len(levels) if it was read from memory.
+        """
+        block = address >> self.block_bits
+        path = self.paths[core]
+        first = path[0]
+
+        state = first.lines.get(block)
+        if state is not None:
+            first.hits += 1
+            # same as first.touch(block), copied since L1 hits are the most common access
+            lru = first.sets[block & first.index_mask]
+            if lru[-1] != block:
+                lru.remove(block)
+                lru.append(block)
+            if self.verbose:
+                self.print_lookup(core, address, write, 0)
+            if write and state != "M":
+                if state == "S":
+                    # there may be copies in other caches
+                    self.snoop(block, core, True)
+                first.lines[block] = "M"
+            return 0
+
+        first.misses += 1
+        n_levels = len(path)
+        depth = 1
+        while depth < n_levels:
+            cache = path[depth]
+            if block in cache.lines:
+                cache.hits += 1
+                cache.touch(block)
+                break
+            cache.misses += 1
+            depth += 1
+        if depth == n_levels:
+            self.memory_reads += 1
+        if self.verbose:
+            self.print_lookup(core, address, write, depth)
+
+        if depth > self.shared_depth:
+            shared = False
         else:
-            return "N"
-
-    def get_tag(self):
-        """
-        Gets tag of block.
-        :return: Int.
-        """
-        return self.tag
-
-    def set_tag(self, tag):
-        """
-        Sets the tag for the block.
-        :param tag: Int.
+            shared = self.snoop(block, core, write)
+        if write:
+            state = "M"
+        elif shared:
+            state = "S"
+        else:
+            state = "E"
+
+        # fill from the farthest level that missed, so parents always hold their children blocks,
+        # the LRU way is replaced, a replaced valid block is invalidated in the children caches and
+        # written back if any copy was modified, this is inlined since it runs on every miss
+        for cache in path[depth - 1::-1]:
+            lru = cache.sets[block & cache.index_mask]
+            victim = lru.pop(0)
+            lru.append(block)
+            lines = cache.lines
+            lines[block] = state if cache is first else "S"
+            if victim is not None:
+                dirty = lines.pop(victim) == "M"
+                for child in cache.children:
+                    if victim in child.lines:
+                        dirty |= self.drop(child, victim)
+                if dirty:
+                    self.write_back(cache, victim)
+        return depth
+
+    def print_lookup(self, core, address, write, depth):
+        """
+        Prints the misses and the hit of an access, before the snoops and evictions it causes.
+        :param core: Int, core index.
+        :param address: Int, memory address to read/write.
+        :param write: Bool, True for a write.
+        :param depth: Int, level where the block was found, len(levels) if it was read from memory.
         :return: None.
         """
-        self.tag = tag
-
-    def get_state(self):
-        """
-        Gets the state of the block.
-        :return: State for the corresponding block, where state may be [MESI].
-        """
-        return self.MESI
-
-    def set_state(self, tag, state_value):
-        """
-        Sets the states of the block with a given tag, if the tags are different there is no change in the block state.
-        :param tag: Int.
-        :param state_value: New block state, where state may be [MESI]
+        cpu = "CPU{0}".format(core + 1)
+        action = "Write" if write else "Read"
+        for name in self.level_names[:depth]:
+            print "{0}: {1} MISS {2}, address {3}".format(cpu, action, name, address)
+        if depth < len(self.level_names):
+            print "{0}: {1} HIT {2}, address {3}".format(cpu, action, self.level_names[depth], address)
+        else:
+            print "{0}: Must read from memory, address {1}".format(cpu, address)
+
+    def snoop(self, block, core, invalidate):
+        """
+        Finds the copies of a block outside the caches used by a core, they are invalidated on a
+        write or set to S on a read, modified copies are written back first.
+        :param block: Int, block address.
+        :param core: Int, index of the requesting core.
+        :param invalidate: Bool, True to invalidate the copies, False to share them.
+        :return: Bool, True if there was any copy.
+        """
+        found = False
+        for cache in self.neighbours[core]:
+            if block in cache.lines:
+                found = True
+                if invalidate:
+                    if self.verbose:
+                        print "{0}: Invalidating copy, address {1}".format(cache.name, block << self.block_bits)
+                    dirty = self.drop(cache, block)
+                else:
+                    dirty = self.share(cache, block)
+                if dirty:
+                    self.write_back(cache, block)
+        return found
+
+    def drop(self, cache, block):
+        """
+        Invalidates a block in a cache and its children.
+        :param cache: Cache object holding the block.
+        :param block: Int, block address.
+        :return: Bool, True if any of the copies was modified.
+        """
+        dirty = cache.invalidate(block) == "M"
+        for child in cache.children:
+            if block in child.lines:
+                dirty |= self.drop(child, block)
+        return dirty
+
+    def share(self, cache, block):
+        """
+        Sets a block to S in a cache and its children.
+        :param cache: Cache object holding the block.
+        :param block: Int, block address.
+        :return: Bool, True if any of the copies was modified.
+        """
+        dirty = cache.lines[block] == "M"
+        cache.lines[block] = "S"
+        for child in cache.children:
+            if block in child.lines:
+                dirty |= self.share(child, block)
+        return dirty
+
+    def write_back(self, cache, block):
+        """
+        Writes a modified block back to the parent of a cache, or to memory for the last level.
+        :param cache: Cache object with the modified block.
+        :param block: Int, block address.
         :return: None.
         """
-        if self.tag == tag:
-            self.MESI = state_value
-###############################################################################
+        cache.writebacks += 1
+        parent = cache.parent
+        if parent is not None and block in parent.lines:
+            if self.verbose:
+                print "{0}: Write back to {1}, address {2}".format(cache.name, parent.name,
+                                                                  block << self.block_bits)
+            parent.lines[block] = "M"
+        else:
+            if self.verbose:
+                print "{0}: Write back to memory, address {1}".format(cache.name, block << self.block_bits)
+            self.memory_writebacks += 1
 
 
 ###############################################################################
-# Handles the execution(simulation) of instructions and the state of caches blocks.
+# Handles the execution(simulation) of instructions in every core.
 class CpuMaster:
-    def __init__(self):
-
-        # create caches
-        self.ch_local_cpu1 = CacheL1(256, 2)
-        self.ch_local_cpu2 = CacheL1(256, 2)
-        self.ch_shared_cpu = CacheL2(4*1024)
+    def __init__(self, n_cores=2, levels=None, verbose=True):
+        """
+        Creates the cores and their cache hierarchy.
+        :param n_cores: Number of cores.
+        :param levels: List of LevelSpec, defaults to the default topology.
+        :param verbose: Bool, prints every step of the simulation.
+        """
+        if levels is None:
+            levels = topologies[default_topology][1]
+        self.n_cores = n_cores
+        self.verbose = verbose
+        self.hierarchy = CacheHierarchy(n_cores, levels, verbose=verbose)
 
         # relevant info about performance
-        self.missesL1 = 0       # misses in L1-cpu1
-        self.missesLL1 = 0      # misses in L1-cpu2
-        self.missesL2 = 0       # misses in L2
-        self.cyclecpu1 = 0      # number of clock cycle for the cpu1
-        self.cyclecpu2 = 0      # number of clock cycle for the cpu2
+        self.cycles = [0]*n_cores   # number of clock cycles for each cpu
 
-    def simulate(self, program_core1, program_core2):
+    def simulate(self, programs, weights, log_interval=1):
         """
-        Reads the read/write commands from a file and simulates them.
-        :param program_core1: File name, memory trace for the cpu1.
-        :param program_core2: File name, memory trace for the cpu2.
+        Reads the read/write commands from a file per core and simulates them.
+        :param programs: List of file names, memory trace for each cpu.
+        :param weights: List of ints, number of instructions each cpu runs per round.
+        :param log_interval: Int, number of instructions between csv rows.
         :return: None.
         """
-        print "Processing program {0} in core 1".format(program_core1)
-        print "Processing program {0} in core 2".format(program_core2)
+        if len(weights) != self.n_cores or min(weights) < 1:
+            raise ValueError("Every cpu must run at least 1 instruction per round: {0}".format(weights))
+        if log_interval < 1:
+            raise ValueError("Log interval must be positive: {0}".format(log_interval))
 
-        cpu1_file = open(program_core1, "r")
-        cpu2_file = open(program_core2, "r")
-        # dummy values just to enter the loop
-        cpu1_line = "x"
-        cpu2_line = "x"
+        files = []
+        for core in range(self.n_cores):
+            print "Processing program {0} in core {1}".format(programs[core], core + 1)
+            files += [open(programs[core], "r")]
 
-        # miss counters
-        self.missesL1 = 0
-        self.missesLL1 = 0
-        self.missesL2 = 0
-        self.cyclecpu1 = 0
-        self.cyclecpu2 = 0
+        self.cycles = [0]*self.n_cores
+        cycles = self.cycles
+        caches = self.hierarchy.caches
+        access = self.hierarchy.access
+        execute = self.execute
+        verbose = self.verbose
 
         # saves performance info
-        log_misses = CSVLog()
+        log_misses = CSVLog(["Cycle CPU{0}".format(core + 1) for core in range(self.n_cores)] +
+                            ["Misses {0}".format(cache.name) for cache in caches])
+        countdown = log_interval
+        misses = [0]*len(caches)
+        stale = False              # misses only change when an access misses L1
 
         # begin simulation
-        while cpu1_line or cpu2_line:
-            for n in range(3):
-                cpu1_line = cpu1_file.readline()
-                if cpu1_line:
-                    # process instruction in cpu1
-                    cpu1_instr = cpu1_line.split()
-                    address1 = int(cpu1_instr[0], 16)
-                    mode1 = cpu1_instr[1]
-                    self.execute_cpu1(address1, mode1)
-                    log_misses.write(self.cyclecpu1, self.cyclecpu2, self.missesL1, self.missesLL1, self.missesL2)
-                    self.cyclecpu1 += 1
-
-            cpu2_line = cpu2_file.readline()
-            if cpu2_line:
-                # process instruction in cpu2
-                cpu2_instr = cpu2_line.split()
-                address2 = int(cpu2_instr[0], 16)
-                mode2 = cpu2_instr[1]
-                self.execute_cpu2(address2, mode2)
-                log_misses.write(self.cyclecpu1, self.cyclecpu2, self.missesL1, self.missesLL1, self.missesL2)
-                self.cyclecpu2 += 1
-
-    def execute_cpu1(self, address, mode):
-        """
-        Simulates read/write of address in cpu1.
-        :param address: Int, memory address to read/write.
-        :param mode: Read/write mode, may be L(Read) or S(Write).
-        :return: None.
-        """
-        self.execute_cpu(address=address, mode=mode, local_cache=self.ch_local_cpu1, local_cache_name="CPU1",
-                         extraneous_cache=self.ch_local_cpu2, extraneous_cache_name="CPU2")
-
-    def execute_cpu2(self, address, mode):
-        """
-        Simulates read/write of address in cpu2.
-        :param address: Int, memory address to read/write.
-        :param mode: Read/write mode, may be L(Read) or S(Write).
-        :return: None.
-        """
-        self.execute_cpu(address=address, mode=mode, local_cache=self.ch_local_cpu2, local_cache_name="CPU2",
-                         extraneous_cache=self.ch_local_cpu1, extraneous_cache_name="CPU1")
-
-    def execute_cpu(self, address, mode, local_cache, local_cache_name, extraneous_cache, extraneous_cache_name):
-        """
-        Generic method to execute a read/write instruction.
+        rounds = [range(weight) for weight in weights]
+        running = range(self.n_cores)
+        while running:
+            finished = []
+            for core in running:
+                cpu_file = files[core]
+                for n in rounds[core]:
+                    line = cpu_file.readline()
+                    if not line:
+                        finished += [core]
+                        break
+                    instr = line.split()
+                    if not instr:
+                        continue
+                    write = write_modes.get(instr[1])
+                    if verbose or write is None:
+                        depth = execute(core, int(instr[0], 16), instr[1])
+                    else:
+                        depth = access(core, int(instr[0], 16), write)
+                    if depth:
+                        stale = True
+                    countdown -= 1
+                    if not countdown:
+                        if stale:
+                            misses = [cache.misses for cache in caches]
+                            stale = False
+                        log_misses.write(cycles + misses)
+                        countdown = log_interval
+                    cycles[core] += 1
+            if finished:
+                running = [core for core in running if core not in finished]
+
+        log_misses.close()
+        for cpu_file in files:
+            cpu_file.close()
+        self.report()
+
+    def execute(self, core, address, mode):
+        """
+        Simulates read/write of address in a cpu.
+        :param core: Int, core index.
         :param address: Int, memory address to read/write.
         :param mode: Read/write mode, may be L(Read) or S(Write).
-        :param local_cache: CacheL1 object, corresponds to local cache,
-        defined by from where is the instruction running.
-        :param local_cache_name: String, name of local cache.
-        :param extraneous_cache: CacheL1 object, corresponds to additional cache,
-        the instruction is not running from here running.
-        :param extraneous_cache_name: String, name of additional cache.
-        :return: None.
+        :return: Int, level where the block was found, see CacheHierarchy.access. None for an invalid mode.
         """
-
-        hit_L2 = False
-        # try L1
-        state_L1 = local_cache.read(address)
-
-        if state_L1 in "EMS":
-            hit_L1 = True
-        else:
-            hit_L1 = False
-            # if not in L1 then try L2
-            state_L2 = self.ch_shared_cpu.read(address)
-            if state_L2 in "EMS":
-                hit_L2 = True
-            else:
-                hit_L2 = False
-
-        # reading
-        if mode == 'L':
-            print "{0}: Read address {1}".format(local_cache_name, address)
-
-            if hit_L1:
-                    print "{0}: Read HIT L1, address {1}".format(local_cache_name, address)
-                    # remain in previous state, finish execution
-                    return
-
-            else:
-                    print "{0}: Read MISS L1, address {1}".format(local_cache_name, address)
-                    if local_cache_name == "CPU1":
-                        self.missesL1 += 1
-                    elif local_cache_name == "CPU2":
-                        self.missesLL1 += 1
-
-                    # next step is to check in L2
-
-                    self.delete_procL1(address)
-
-                    if hit_L2:
-                        print "{0}: Read HIT L2, address {1}".format(local_cache_name, address)
-
-                        # check for other L1 copy
-                        mode_copy_cpuext = extraneous_cache.read(address)
-                        if mode_copy_cpuext == "M":
-                            print "Found modified entry in {0}, address {1}".format(extraneous_cache_name, address)
-                            print "{0}: Write back to L2, address {1}".format(extraneous_cache_name, address)
-                            print "{0}: Read updated block from L2, address {1}".format(local_cache_name, address)
-                            extraneous_cache.set_state(address, "I")
-                            local_cache.update_set(address, "E")
-                            self.ch_shared_cpu.set_state(address, "S")
-
-                        elif mode_copy_cpuext == "S":
-                            local_cache.update_set(address, "S")
-                            self.ch_shared_cpu.set_state(address, "S")
-
-                        elif mode_copy_cpuext == "E":
-                            extraneous_cache.set_state(address, "S")
-                            local_cache.update_set(address, "S")
-                            self.ch_shared_cpu.set_state(address, "S")
-
-                        else:
-                            local_cache.update_set(address, "E")
-                            self.ch_shared_cpu.set_state(address, "S")
-
-                    else:
-                        self.missesL2 += 1
-                        print "{0}: Read MISS L2, address {0}, must read from memory".format(local_cache_name, address)
-                        self.delete_procL2(address)
-                        local_cache.update_set(address, "E")
-                        self.ch_shared_cpu.update_set(address, "S")
-
-        # writing
-        elif mode == 'S':
-            print "{0}: Write to address {1}".format(local_cache_name, address)
-
-            if hit_L1:
-                if state_L1 in "EM":
-                    print "{0}: Write HIT L1, address {1}".format(local_cache_name, address)
-                    local_cache.set_state(address, "M")
-
-                elif state_L1 == "S":
-                    print "{0}: Write HIT L1, address {1}".format(local_cache_name, address)
-                    print "{0}: But there is a copy in {1}, invalidating {1} local cache block, address {2}"\
-                        .format(local_cache_name, extraneous_cache_name, address)
-                    local_cache.set_state(address, "M")
-                    extraneous_cache.set_state(address, "I")
-                return
-
-            else:
-                if local_cache_name == "CPU1":
-                    self.missesL1 += 1
-                elif local_cache_name == "CPU2":
-                    self.missesLL1 += 1
-                print "{0}: Write MISS L1, address {1}".format(local_cache_name, address)
-                self.delete_procL1(address)
-
-                if hit_L2:
-                    print "{0}: Write HIT L2, address {1}".format(local_cache_name, address)
-
-                    mode_copy_cpuext = self.ch_local_cpu2.read(address)
-                    if mode_copy_cpuext in "MES":
-                        print "{0}: Invalidating copy, address {1}".format(extraneous_cache_name, address)
-                        local_cache.update_set(address, "M")
-                        extraneous_cache.set_state(address, "I")
-                        self.ch_shared_cpu.set_state(address, "S")
-                    else:
-                        local_cache.update_set(address, "M")
-                        self.ch_shared_cpu.set_state(address, "S")
-                else:
-                    self.missesL2 += 1
-                    print "{0}: Write MISS L2, address {1}".format(local_cache_name, address)
-                    self.delete_procL2(address)
-                    local_cache.update_set(address, "M")
-                    self.ch_shared_cpu.update_set(address, "S")
-
-        else:
+        write = write_modes.get(mode)
+        if write is None:
             print "Invalid action: {0}".format(mode)
+            return None
 
-    def delete_procL1(self, address):
-        """
-        Deletes a block in the L1-cpu1 cache, and handles write-backs if necessary.
-        :param address: Int, memory address of the block that it is about to be replaced.
-        :return: None.
-        """
-        address = self.ch_local_cpu1.get_similar(address)
-        mode_L1 = self.ch_local_cpu1.read(address)
-
-        if mode_L1 in "ESIN":
-            None  # No action required
-
-        elif mode_L1 == "M":
-            print "Value to overwrite in L1 cpu1 is in M state, " \
-                  "write back to L2, address {0}".format(address)
-            self.ch_shared_cpu.set_state(address, "M")
+        if self.verbose:
+            print "CPU{0}: {1} address {2}".format(core + 1, "Write to" if write else "Read", address)
+        return self.hierarchy.access(core, address, write)
 
-        else:
-            print "Invalid mode in L1 cpu1: {0}".format(mode_L1)
-
-    def delete_procLL1(self, address):
-        """
-        Deletes a block in the L1-cpu2 cache, and handles write-backs if necessary.
-        :param address: Int, memory address of the block that it is about to be replaced.
-        :return: None.
-        """
-        address = self.ch_local_cpu2.get_similar(address)
-        mode_LL1 = self.ch_local_cpu2.read(address)
-
-        if mode_LL1 in "ESIN":
-            None  # No action required
-
-        elif mode_LL1 == "M":
-            print "Value to overwrite in L1 cpu2 is in M state, " \
-                  "write back to L2, address {0}".format(address)
-            self.ch_shared_cpu.set_state(address, "M")
-
-        else:
-            print "Invalid mode in L1 cpu2: {0}".format(mode_LL1)
-
-    def delete_procL2(self, address):
+    def report(self):
         """
-        Deletes a block in the L2 cache, and handles snoop-invalidate and write-backs if necessary.
-        :param address: Int, memory address of the block that it is about to be replaced.
+        Prints hits, misses and write-backs of every cache.
         :return: None.
         """
-        address = self.ch_shared_cpu.get_similar(address)
-
-        # get state
-        mode_L2 = self.ch_shared_cpu.read(address)
-
-        if mode_L2 in "EIN":
-            None  # No action required
-
-        elif mode_L2 == "M":
-            print "Value to overwrite in L2 is in M state, " \
-                  "write back to memory, address {0}".format(address)
-
-        elif mode_L2 == "S":
-            # invalidate L1 entries
-            self.ch_local_cpu1.set_state(address, "I")
-            self.ch_local_cpu2.set_state(address, "I")
-
-        else:
-            print "Invalid mode in L2: {0}".format(mode_L2)
+        for cache in self.hierarchy.caches:
+            print "{0}: {1} hits, {2} misses, {3} write-backs".format(cache.name, cache.hits, cache.misses,
+                                                                      cache.writebacks)
+        print "Memory: {0} reads, {1} write-backs".format(self.hierarchy.memory_reads,
+                                                         self.hierarchy.memory_writebacks)
 
 
 ###############################################################################
 def main():
     # Obtaining parameters from cli
     parser = argparse.ArgumentParser(
-        description='''Simulates the use of a multilevel cache, used by two cores''')
-
-    parser.add_argument('program_core1', nargs='?',
-                        default=default_programcpu1,
-                        help='program to execute with cpu1')
-    parser.add_argument('program_core2', nargs='?',
-                        default=default_programcpu2,
-                        help='program to execute with cpu2')
+        description='''Simulates the use of a multilevel cache, used by several cores''')
+
+    parser.add_argument('programs', nargs='*',
+                        default=[default_programcpu1, default_programcpu2],
+                        help='programs to execute, one per cpu, reused cyclically if there are more cpus')
+    parser.add_argument('-t', '--topology', choices=sorted(topologies),
+                        default=default_topology,
+                        help='predefined cache hierarchy')
+    parser.add_argument('-l', '--levels',
+                        help='custom cache hierarchy, overrides the topology levels, '
+                             'e.g. L1:256x2:private,L2:1024x4:4,L3:8192x16:shared')
+    parser.add_argument('-c', '--cores', type=int,
+                        help='number of cpus, defaults to the topology one')
+    parser.add_argument('-w', '--weights', default=default_weights,
+                        help='instructions run by each cpu per round, missing cpus run 1')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only print the final statistics')
+    parser.add_argument('--log-interval', type=int, default=1,
+                        help='instructions between rows of the csv file')
     args = parser.parse_args()
 
-    cores = CpuMaster()  # manages the two cores
+    n_cores, levels = topologies[args.topology]
+    if args.cores is not None:
+        n_cores = args.cores
+    try:
+        if args.levels:
+            levels = parse_levels(args.levels)
+        try:
+            weights = [int(n) for n in args.weights.split(",")]
+        except ValueError:
+            raise ValueError("Invalid weights {0}, expected a comma separated list of ints".format(args.weights))
+        cores = CpuMaster(n_cores, levels, verbose=not args.quiet)  # manages the cores
+    except ValueError as error:
+        parser.error(str(error))
+    if args.log_interval < 1:
+        parser.error("Log interval must be positive: {0}".format(args.log_interval))
+    if min(weights) < 1:
+        parser.error("Weights must be positive: {0}".format(args.weights))
+    weights = (weights + [1]*n_cores)[:n_cores]
+    programs = [args.programs[core % len(args.programs)] for core in range(n_cores)]
 
     # begins simulation
-    cores.simulate(args.program_core1, args.program_core2)
+    cores.simulate(programs, weights, args.log_interval)
 
 if __name__ == "__main__":
     main()
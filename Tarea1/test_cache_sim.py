@@ -0,0 +1,173 @@
+#! /usr/bin/python2.7
+import random
+import unittest
+
+from cache_sim import CacheHierarchy, LevelSpec, parse_levels, topologies
+
+
+###############################################################################
+# Helpers
+def block_address(block):
+    """
+    Forms the address of the first byte of a block, blocks are 32 bytes.
+    :param block: Int, block address.
+    :return: Int, memory address.
+    """
+    return block << 5
+
+
+def check_invariants(test, hierarchy):
+    """
+    Checks that the hierarchy is consistent:
+    every set holds exactly the valid blocks of the cache, every block is also in the parent cache
+    (inclusion) and a block in M or E state in a L1 cache is not present in any other L1 cache.
+    :param test: TestCase object used for the assertions.
+    :param hierarchy: CacheHierarchy object.
+    :return: None.
+    """
+    for cache in hierarchy.caches:
+        blocks = [block for lru in cache.sets for block in lru if block is not None]
+        test.assertEqual(sorted(blocks), sorted(cache.lines), cache.name)
+        if cache.parent is not None:
+            for block in cache.lines:
+                test.assertIn(block, cache.parent.lines, "{0} block {1}".format(cache.name, block))
+
+    owners = {}
+    for cache in hierarchy.levels[0]:
+        for block, state in cache.lines.items():
+            owners.setdefault(block, []).append(state)
+    for block, states in owners.items():
+        if "M" in states or "E" in states:
+            test.assertEqual(len(states), 1, "block {0} states {1}".format(block, states))
+
+
+###############################################################################
+class TestInvariants(unittest.TestCase):
+
+    def test_random_accesses(self):
+        """
+        Random reads/writes on small versions of every topology keep the hierarchy consistent.
+        """
+        generator = random.Random(26)
+        for name in sorted(topologies):
+            n_cores, levels = topologies[name]
+            small = [LevelSpec(spec.name, 8, 2, spec.cores_per_cache) for spec in levels]
+            hierarchy = CacheHierarchy(n_cores, small)
+            for n in range(20000):
+                hierarchy.access(generator.randrange(n_cores), block_address(generator.randrange(128)),
+                                 generator.random() < 0.3)
+                if n % 101 == 0:
+                    check_invariants(self, hierarchy)
+            check_invariants(self, hierarchy)
+
+
+###############################################################################
+class TestScenarios(unittest.TestCase):
+
+    def setUp(self):
+        n_cores, levels = topologies["default"]
+        self.hierarchy = CacheHierarchy(n_cores, levels)
+        self.l1_cpu1, self.l1_cpu2 = self.hierarchy.levels[0]
+        self.l2 = self.hierarchy.levels[1][0]
+
+    def test_read_share(self):
+        """
+        A read of a block held by another core hits L2 and leaves both copies in S.
+        """
+        block = 0x8001
+        self.assertEqual(self.hierarchy.access(0, block_address(block), False), 2)
+        self.assertEqual(self.l1_cpu1.lines[block], "E")
+
+        self.assertEqual(self.hierarchy.access(1, block_address(block), False), 1)
+        self.assertEqual(self.l1_cpu1.lines[block], "S")
+        self.assertEqual(self.l1_cpu2.lines[block], "S")
+        self.assertEqual(self.hierarchy.memory_reads, 1)
+        check_invariants(self, self.hierarchy)
+
+    def test_write_invalidate(self):
+        """
+        A write to a shared block invalidates the other copy, a write by the other core then
+        writes the modified block back before invalidating it.
+        """
+        block = 0x8001
+        self.hierarchy.access(0, block_address(block), False)
+        self.hierarchy.access(1, block_address(block), False)
+
+        self.assertEqual(self.hierarchy.access(0, block_address(block), True), 0)
+        self.assertEqual(self.l1_cpu1.lines[block], "M")
+        self.assertNotIn(block, self.l1_cpu2.lines)
+
+        self.assertEqual(self.hierarchy.access(1, block_address(block), True), 1)
+        self.assertNotIn(block, self.l1_cpu1.lines)
+        self.assertEqual(self.l1_cpu2.lines[block], "M")
+        self.assertEqual(self.l1_cpu1.writebacks, 1)
+        self.assertEqual(self.l2.lines[block], "M")
+        check_invariants(self, self.hierarchy)
+
+    def test_dirty_eviction_write_back(self):
+        """
+        Replacing a modified L1 block writes it back to L2, not to memory.
+        """
+        block = 0x8001
+        # same L1 set (256 sets, 2 ways), different L2 sets
+        for other in [block, block + 256, block + 512]:
+            self.hierarchy.access(0, block_address(other), other == block)
+
+        self.assertNotIn(block, self.l1_cpu1.lines)
+        self.assertEqual(self.l2.lines[block], "M")
+        self.assertEqual(self.l1_cpu1.writebacks, 1)
+        self.assertEqual(self.hierarchy.memory_writebacks, 0)
+        check_invariants(self, self.hierarchy)
+
+    def test_l2_eviction_back_invalidates_dirty_l1(self):
+        """
+        Replacing a L2 block invalidates the modified L1 copy and writes it back to memory.
+        """
+        block = 0x8001
+        self.hierarchy.access(0, block_address(block), True)
+        # same set in the direct-mapped L2 (4096 sets), the L1 set still has a free way
+        self.hierarchy.access(0, block_address(block + 4096), False)
+
+        self.assertNotIn(block, self.l2.lines)
+        self.assertNotIn(block, self.l1_cpu1.lines)
+        self.assertEqual(self.l2.writebacks, 1)
+        self.assertEqual(self.hierarchy.memory_writebacks, 1)
+        check_invariants(self, self.hierarchy)
+
+    def test_l3_eviction_back_invalidates_dirty_l1(self):
+        """
+        Replacing a block in a shared direct-mapped L3 invalidates the copies in the private L2 and L1.
+        """
+        hierarchy = CacheHierarchy(2, parse_levels("L1:4x2:private,L2:4x4:private,L3:4x1:shared"))
+        l1_cpu1 = hierarchy.levels[0][0]
+        l2_cpu1 = hierarchy.levels[1][0]
+        l3 = hierarchy.levels[2][0]
+        block = 1
+
+        hierarchy.access(0, block_address(block), True)
+        hierarchy.access(0, block_address(block + 4), False)
+
+        for cache in [l1_cpu1, l2_cpu1, l3]:
+            self.assertNotIn(block, cache.lines, cache.name)
+        self.assertEqual(l3.writebacks, 1)
+        self.assertEqual(hierarchy.memory_writebacks, 1)
+        check_invariants(self, hierarchy)
+
+
+###############################################################################
+class TestSpec(unittest.TestCase):
+
+    def test_parse_levels(self):
+        levels = parse_levels("L1:256x2:private,L2:1024x4:4,L3:8192x16:shared")
+        self.assertEqual([(spec.name, spec.n_sets, spec.n_ways, spec.cores_per_cache) for spec in levels],
+                         [("L1", 256, 2, 1), ("L2", 1024, 4, 4), ("L3", 8192, 16, None)])
+
+    def test_invalid_hierarchy(self):
+        self.assertRaises(ValueError, parse_levels, "L1:256:private")
+        self.assertRaises(ValueError, CacheHierarchy, 2, [LevelSpec("L1", 100, 2)])
+        self.assertRaises(ValueError, CacheHierarchy, 3, [LevelSpec("L1", 256, 2), LevelSpec("L2", 1024, 4, 2)])
+        self.assertRaises(ValueError, CacheHierarchy, 4, [LevelSpec("L1", 256, 2, 2), LevelSpec("L2", 1024, 4, 3)])
+
+
+if __name__ == "__main__":
+    unittest.main()